@@ -27,6 +27,7 @@ from .store import (
     reload,
     remove,
     set,
+    transaction,
     unlock,
 )
 
@@ -44,5 +45,6 @@ __all__ = [
     "reload",
     "remove",
     "set",
+    "transaction",
     "unlock",
 ]
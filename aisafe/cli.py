@@ -3,6 +3,7 @@ CLI interface for aisafe.
 
 Usage:
     aisafe set <key> [value]       Set a credential (interactive if no value)
+    aisafe set --batch <file>      Set many credentials from key=value lines
     aisafe get <key>               Get a credential value
     aisafe list [section]          List sections or keys within a section
     aisafe remove <key>            Remove a credential
@@ -14,13 +15,24 @@ Usage:
 
 from __future__ import annotations
 
-import argparse
 import getpass
 import os
 import sys
+from pathlib import Path
+from typing import TYPE_CHECKING
 
 from . import store
-from .paths import get_credentials_path
+
+if TYPE_CHECKING:
+    import argparse
+
+
+def _stat(path: Path) -> os.stat_result | None:
+    """Stat a file, returning None if it does not exist."""
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        return None
 
 
 def _ensure_unlocked() -> None:
@@ -30,8 +42,50 @@ def _ensure_unlocked() -> None:
         store.unlock(password)
 
 
+def _read_batch(path: str) -> list[tuple[str, str]]:
+    """Read key=value lines from a file ('-' for stdin), skipping blanks and comments.
+
+    Keys are stripped; values are kept verbatim, since whitespace may be part
+    of a secret. Lines are split on LF only (a trailing CR is dropped), so
+    characters such as form feed or U+2028 stay inside a value.
+    """
+    if path == "-":
+        text = sys.stdin.buffer.read().decode("utf-8")
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            text = f.read()
+
+    pairs: list[tuple[str, str]] = []
+    for lineno, line in enumerate(text.split("\n"), 1):
+        line = line.removesuffix("\r")
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        key, sep, value = line.partition("=")
+        if not sep or not key.strip():
+            print(f"✗ {path}:{lineno}: expected key=value", file=sys.stderr)
+            sys.exit(1)
+        pairs.append((key.strip(), value))
+    return pairs
+
+
 def cmd_set(args: argparse.Namespace) -> None:
     """Set a credential value."""
+    if args.batch is not None:
+        if args.key is not None or args.value is not None:
+            print("✗ Cannot combine key/value with --batch", file=sys.stderr)
+            sys.exit(1)
+        pairs = _read_batch(args.batch)
+        _ensure_unlocked()
+        with store.transaction():
+            for batch_key, batch_value in pairs:
+                store.set(batch_key, batch_value)
+        print(f"✓ Set {len(pairs)} key(s)")
+        return
+
+    if args.key is None:
+        print("✗ Missing key (or use --batch <file>)", file=sys.stderr)
+        sys.exit(1)
+
     _ensure_unlocked()
     key: str = args.key
     if args.value is not None:
@@ -45,10 +99,15 @@ def cmd_set(args: argparse.Namespace) -> None:
 
 def cmd_get(args: argparse.Namespace) -> None:
     """Get a credential value."""
+    cmd_get_fast(args.key)
+
+
+def cmd_get_fast(key: str) -> None:
+    """Get a credential value without going through argparse."""
     _ensure_unlocked()
-    value = store.get(args.key)
+    value = store.get(key)
     if value is None:
-        print(f"✗ Key '{args.key}' not found", file=sys.stderr)
+        print(f"✗ Key '{key}' not found", file=sys.stderr)
         sys.exit(1)
     print(value)
 
@@ -88,12 +147,11 @@ def cmd_remove(args: argparse.Namespace) -> None:
 
 def cmd_path(args: argparse.Namespace) -> None:
     """Show credentials file path."""
-    plain_path = get_credentials_path()
-    enc_path = plain_path.with_suffix(".toml.enc")
+    plain_path, enc_path = store._get_paths()
 
-    if enc_path.exists():
+    if _stat(enc_path) is not None:
         print(f"{enc_path} (encrypted 🔒)")
-    elif plain_path.exists():
+    elif _stat(plain_path) is not None:
         print(f"{plain_path} (plaintext ⚠️)")
     else:
         print(f"{plain_path} (not created yet)")
@@ -105,7 +163,7 @@ def cmd_encrypt(args: argparse.Namespace) -> None:
         print("✗ Already encrypted", file=sys.stderr)
         sys.exit(1)
 
-    plain_path = get_credentials_path()
+    plain_path, enc_path = store._get_paths()
     if not plain_path.exists():
         print("✗ No credentials file to encrypt", file=sys.stderr)
         sys.exit(1)
@@ -121,7 +179,7 @@ def cmd_encrypt(args: argparse.Namespace) -> None:
 
     store.encrypt_store(password)
     print("✓ Credentials encrypted 🔒")
-    print(f"  File: {plain_path.with_suffix('.toml.enc')}")
+    print(f"  File: {enc_path}")
     print(f"  Plaintext file removed")
 
 
@@ -140,75 +198,112 @@ def cmd_decrypt(args: argparse.Namespace) -> None:
         sys.exit(1)
 
     print("✓ Credentials decrypted to plaintext ⚠️")
-    print(f"  File: {get_credentials_path()}")
+    print(f"  File: {store._get_path()}")
 
 
 def cmd_status(args: argparse.Namespace) -> None:
     """Show encryption status."""
-    plain_path = get_credentials_path()
-    enc_path = plain_path.with_suffix(".toml.enc")
+    plain_path, enc_path = store._get_paths()
 
-    if enc_path.exists():
-        size = enc_path.stat().st_size
+    if (st := _stat(enc_path)) is not None:
         print(f"Status: Encrypted 🔒")
         print(f"File:   {enc_path}")
-        print(f"Size:   {size} bytes")
-    elif plain_path.exists():
-        size = plain_path.stat().st_size
+        print(f"Size:   {st.st_size} bytes")
+    elif (st := _stat(plain_path)) is not None:
         print(f"Status: Plaintext ⚠️  (run 'aisafe encrypt' to protect)")
         print(f"File:   {plain_path}")
-        print(f"Size:   {size} bytes")
+        print(f"Size:   {st.st_size} bytes")
     else:
         print(f"Status: No credentials file")
         print(f"Run 'aisafe set <section>.<key>' to create one.")
 
 
-def main() -> None:
-    """CLI entry point."""
-    parser = argparse.ArgumentParser(
-        prog="aisafe",
-        description="Local credential manager — keep secrets invisible to AI coding assistants",
-    )
-    subparsers = parser.add_subparsers(dest="command", required=True)
-
-    # set
+def _build_set_parser(subparsers: argparse._SubParsersAction) -> None:
     p_set = subparsers.add_parser("set", help="Set a credential value")
-    p_set.add_argument("key", help="Key in section.field format, e.g. database.password")
+    p_set.add_argument("key", nargs="?", default=None, help="Key in section.field format, e.g. database.password")
     p_set.add_argument("value", nargs="?", default=None, help="Value (omit for interactive input)")
+    p_set.add_argument("--batch", metavar="FILE", default=None, help="Read key=value lines from FILE ('-' for stdin)")
     p_set.set_defaults(func=cmd_set)
 
-    # get
+
+def _build_get_parser(subparsers: argparse._SubParsersAction) -> None:
     p_get = subparsers.add_parser("get", help="Get a credential value")
     p_get.add_argument("key", help="Key in section.field format")
     p_get.set_defaults(func=cmd_get)
 
-    # list
+
+def _build_list_parser(subparsers: argparse._SubParsersAction) -> None:
     p_list = subparsers.add_parser("list", help="List sections or keys")
     p_list.add_argument("section", nargs="?", default=None, help="Section name (optional)")
     p_list.set_defaults(func=cmd_list)
 
-    # remove
+
+def _build_remove_parser(subparsers: argparse._SubParsersAction) -> None:
     p_remove = subparsers.add_parser("remove", help="Remove a credential")
     p_remove.add_argument("key", help="Key in section.field format")
     p_remove.set_defaults(func=cmd_remove)
 
-    # path
+
+def _build_path_parser(subparsers: argparse._SubParsersAction) -> None:
     p_path = subparsers.add_parser("path", help="Show credentials file path")
     p_path.set_defaults(func=cmd_path)
 
-    # encrypt
+
+def _build_encrypt_parser(subparsers: argparse._SubParsersAction) -> None:
     p_encrypt = subparsers.add_parser("encrypt", help="Encrypt the credential file")
     p_encrypt.set_defaults(func=cmd_encrypt)
 
-    # decrypt
+
+def _build_decrypt_parser(subparsers: argparse._SubParsersAction) -> None:
     p_decrypt = subparsers.add_parser("decrypt", help="Decrypt back to plaintext")
     p_decrypt.set_defaults(func=cmd_decrypt)
 
-    # status
+
+def _build_status_parser(subparsers: argparse._SubParsersAction) -> None:
     p_status = subparsers.add_parser("status", help="Show encryption status")
     p_status.set_defaults(func=cmd_status)
 
-    args = parser.parse_args()
+
+_PARSER_BUILDERS = {
+    "set": _build_set_parser,
+    "get": _build_get_parser,
+    "list": _build_list_parser,
+    "remove": _build_remove_parser,
+    "path": _build_path_parser,
+    "encrypt": _build_encrypt_parser,
+    "decrypt": _build_decrypt_parser,
+    "status": _build_status_parser,
+}
+
+
+def main(argv: list[str] | None = None) -> None:
+    """CLI entry point."""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # Fast path for the common scripted case: `aisafe get <key>`
+    if len(argv) == 2 and argv[0] == "get" and not argv[1].startswith("-"):
+        cmd_get_fast(argv[1])
+        return
+
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="aisafe",
+        description="Local credential manager — keep secrets invisible to AI coding assistants",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    # Only build the subparser for the requested command; fall back to
+    # the full set for --help, typos and a missing command.
+    command = argv[0] if argv else None
+    if command in _PARSER_BUILDERS:
+        _PARSER_BUILDERS[command](subparsers)
+    else:
+        for build in _PARSER_BUILDERS.values():
+            build(subparsers)
+
+    args = parser.parse_args(argv)
     args.func(args)
 
 
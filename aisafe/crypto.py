@@ -1,56 +1,339 @@
 """
-AES-GCM encryption for credential files.
+AEAD encryption for credential files.
 
-Uses PBKDF2 for key derivation and AES-256-GCM for authenticated encryption.
+Uses Argon2id (when `argon2-cffi` is installed) or PBKDF2 for key
+derivation and AES-256-GCM or ChaCha20-Poly1305 for authenticated
+encryption. CPU features are probed once at import: AES-GCM is chosen
+when the CPU has AES instructions, ChaCha20-Poly1305 otherwise. New
+PBKDF2 files use an iteration count calibrated to the local CPU (never
+below 600 000), cached in kdf.json in the config directory.
 All operations use the `cryptography` library.
 
 File format (.enc):
-    [16 bytes salt][12 bytes nonce][16 bytes tag][N bytes ciphertext]
+    [6 bytes "AISAFE"][1 byte version][1 byte kdf << 4 | algorithm][kdf params]
+    [16 bytes salt][12 bytes nonce][N bytes ciphertext][16 bytes tag]
+
+    kdf params:
+        PBKDF2:   [4 bytes iterations]
+        Argon2id: [1 byte time_cost][4 bytes memory_cost KiB][1 byte parallelism]
+
+Files without the "AISAFE" magic are read as the original headerless
+layout: [16 bytes salt][12 bytes nonce][ciphertext][tag], AES-256-GCM
+with PBKDF2 (600 000 iterations).
+
+Log (appended after a snapshot by the store):
+    [16 bytes snapshot tag][record][record]...
+
+    record: [4 bytes length][12 bytes nonce][N bytes ciphertext][16 bytes tag]
+
+    Records use the snapshot's key and algorithm. The snapshot tag and the
+    record's sequence number are authenticated as associated data, so
+    records cannot be moved to another snapshot or reordered. The header
+    identifies a log left behind by an interrupted compaction: its tag no
+    longer matches the snapshot and the whole log is ignored. A record
+    whose length runs past the end is a torn append; it is skipped when
+    reading, but the store refuses to compact such a log away.
 """
 
 from __future__ import annotations
 
+import functools
+import json
 import os
 import hashlib
+import struct
+import sys
+import time
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
 
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+try:
+    from argon2.low_level import Type as _Argon2Type, hash_secret_raw
 
+    _HAS_ARGON2 = True
+except ImportError:  # optional: pip install aisafe[argon2]
+    _HAS_ARGON2 = False
 
-# PBKDF2 参数
+
+# PBKDF2 参数 (PBKDF2_ITERATIONS 为下限，新文件按硬件校准)
 PBKDF2_ITERATIONS = 600_000
+PBKDF2_TARGET_SECONDS = 0.25
+PBKDF2_MAX_ITERATIONS = 10_000_000
+KDF_CALIBRATION_FILENAME = "kdf.json"
 SALT_SIZE = 16
 KEY_SIZE = 32  # AES-256
 NONCE_SIZE = 12  # GCM standard
+TAG_SIZE = 16
+
+# Argon2id 参数 (OWASP 推荐: 19 MiB, t=2, p=1)
+ARGON2_TIME_COST = 2
+ARGON2_MEMORY_COST = 19_456  # KiB
+ARGON2_PARALLELISM = 1
+# 读取文件时接受的 Argon2id 参数上限，防止构造的文件耗尽内存或时间
+ARGON2_MAX_TIME_COST = 10
+ARGON2_MAX_MEMORY_COST = 262_144  # KiB (256 MiB)
+ARGON2_MAX_PARALLELISM = 16
+
+# 文件头: magic + 格式版本；没有 magic 的文件按无头旧格式读取
+_MAGIC = b"AISAFE"
+_FORMAT_VERSION = 1
+
+# 算法标识 (算法字节低 4 位)
+_ALG_AES_GCM = 1
+_ALG_CHACHA = 2
+_ALG_AEGIS256 = 3  # 预留：暂无可用的 Python 绑定
+_ALGORITHMS = (_ALG_AES_GCM, _ALG_CHACHA)
+
+# 密钥派生标识 (算法字节高 4 位)
+_KDF_PBKDF2 = 1
+_KDF_ARGON2 = 2
+_PBKDF2_PARAMS = struct.Struct(">I")
+_ARGON2_PARAMS = struct.Struct(">BIB")
+
+# 日志记录: 长度前缀和作为关联数据的序号
+_RECORD_LEN = struct.Struct(">I")
+_RECORD_SEQ = struct.Struct(">I")
+
+# KDF 描述: (_KDF_PBKDF2, iterations) 或 (_KDF_ARGON2, time_cost, memory_cost, parallelism)
+Kdf = tuple[int, ...]
+_LEGACY_KDF: Kdf = (_KDF_PBKDF2, PBKDF2_ITERATIONS)
+
+# (salt, password, kdf) -> (派生密钥, AES 算法对象)，进程内缓存，避免重复派生
+_KEY_CACHE: dict[tuple[bytes, str, Kdf], tuple[bytes, algorithms.AES]] = {}
+# password -> 本会话最近使用的 (salt, kdf)，KDF 相同时写入复用以命中 _KEY_CACHE
+_SESSION: dict[str, tuple[bytes, Kdf]] = {}
+
+
+def _probe_cpu() -> tuple[bool, bool]:
+    """探测 CPU 的 AES 和 SHA-256 硬件指令支持，返回 (has_aes, has_sha)
+
+    无法判断时 AES 视为支持 (保持 AES-GCM)，SHA 视为不支持。
+    """
+    if sys.platform.startswith("linux"):
+        try:
+            with open("/proc/cpuinfo", encoding="utf-8") as f:
+                for line in f:
+                    if line.startswith(("flags", "Features")):
+                        flags = line.split()
+                        return "aes" in flags, "sha_ni" in flags or "sha2" in flags
+        except OSError:
+            pass
+    elif sys.platform == "darwin" and os.uname().machine == "arm64":
+        return True, True
+    return True, False
+
+
+# 导入时探测一次 CPU 特性并选定默认算法，之后不再重复探测
+_HAS_AES, _HAS_SHA_NI = _probe_cpu()
+_DEFAULT_ALGORITHM = _ALG_AES_GCM if _HAS_AES else _ALG_CHACHA
+
+
+def default_algorithm() -> int:
+    """返回当前机器上最快的 AEAD 算法标识"""
+    return _DEFAULT_ALGORITHM
+
+
+def default_kdf() -> Kdf:
+    """返回新文件使用的 KDF：可用时选 Argon2id，否则按硬件校准的 PBKDF2"""
+    if _HAS_ARGON2:
+        return (_KDF_ARGON2, ARGON2_TIME_COST, ARGON2_MEMORY_COST, ARGON2_PARALLELISM)
+    return (_KDF_PBKDF2, _pbkdf2_iterations())
+
+
+@functools.cache
+def _pbkdf2_iterations() -> int:
+    """返回 PBKDF2 迭代次数：约 PBKDF2_TARGET_SECONDS 耗时，限制在允许范围内
+
+    校准结果保存在配置目录的 kdf.json 中，CPU 的 SHA 指令支持变化时重新测量。
+    """
+    from .paths import get_config_dir
+
+    path = get_config_dir() / KDF_CALIBRATION_FILENAME
+    try:
+        saved = json.loads(path.read_text(encoding="utf-8"))
+        if saved.get("sha_ni") == _HAS_SHA_NI:
+            return _clamp_iterations(int(saved["pbkdf2_iterations"]))
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+
+    sample = 50_000
+    start = time.perf_counter()
+    hashlib.pbkdf2_hmac("sha256", b"calibrate", b"\0" * SALT_SIZE, sample, dklen=KEY_SIZE)
+    elapsed = max(time.perf_counter() - start, 1e-6)
+    iterations = int(sample * PBKDF2_TARGET_SECONDS / elapsed) // 10_000 * 10_000
+    iterations = _clamp_iterations(iterations)
+
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(
+            json.dumps({"pbkdf2_iterations": iterations, "sha_ni": _HAS_SHA_NI}),
+            encoding="utf-8",
+        )
+    except OSError:
+        pass
+    return iterations
+
+
+def _clamp_iterations(iterations: int) -> int:
+    """把迭代次数限制在 [PBKDF2_ITERATIONS, PBKDF2_MAX_ITERATIONS] 内"""
+    return min(max(iterations, PBKDF2_ITERATIONS), PBKDF2_MAX_ITERATIONS)
+
+
+def derive_key(password: str, salt: bytes, kdf: Kdf = _LEGACY_KDF) -> bytes:
+    """从密码派生 256 位密钥，结果按 (salt, password, kdf) 缓存"""
+    return _get_cached(password, salt, kdf)[0]
+
+
+def _get_algorithm(password: str, salt: bytes, kdf: Kdf) -> algorithms.AES:
+    """返回缓存的 AES 算法对象，供 Cipher 复用"""
+    return _get_cached(password, salt, kdf)[1]
+
+
+def _get_cached(
+    password: str, salt: bytes, kdf: Kdf
+) -> tuple[bytes, algorithms.AES]:
+    """派生或读取缓存的 (密钥, AES 算法对象)"""
+    cache_key = (salt, password, kdf)
+    entry = _KEY_CACHE.get(cache_key)
+    if entry is None:
+        key = _derive(password, salt, kdf)
+        entry = (key, algorithms.AES(key))
+        _KEY_CACHE[cache_key] = entry
+    return entry
 
 
-def derive_key(password: str, salt: bytes) -> bytes:
-    """从密码派生 AES-256 密钥 (PBKDF2-HMAC-SHA256)"""
+def _derive(password: str, salt: bytes, kdf: Kdf) -> bytes:
+    """按 KDF 描述执行一次密钥派生 (不缓存)"""
+    _validate_kdf(kdf)
+    if kdf[0] == _KDF_ARGON2:
+        if not _HAS_ARGON2:
+            raise RuntimeError(
+                "凭证使用 Argon2id 加密，请先安装 argon2-cffi "
+                "(pip install aisafe[argon2])"
+            )
+        _, time_cost, memory_cost, parallelism = kdf
+        return hash_secret_raw(
+            password.encode("utf-8"),
+            salt,
+            time_cost=time_cost,
+            memory_cost=memory_cost,
+            parallelism=parallelism,
+            hash_len=KEY_SIZE,
+            type=_Argon2Type.ID,
+        )
     return hashlib.pbkdf2_hmac(
         "sha256",
         password.encode("utf-8"),
         salt,
-        PBKDF2_ITERATIONS,
+        kdf[1],
         dklen=KEY_SIZE,
     )
 
 
-def encrypt(plaintext: bytes, password: str) -> bytes:
-    """加密数据，返回 salt + nonce + tag + ciphertext
+def _validate_kdf(kdf: Kdf) -> None:
+    """检查 KDF 参数在允许范围内，否则抛出 ValueError"""
+    if kdf[0] == _KDF_PBKDF2 and len(kdf) == 2:
+        if PBKDF2_ITERATIONS <= kdf[1] <= PBKDF2_MAX_ITERATIONS:
+            return
+    elif kdf[0] == _KDF_ARGON2 and len(kdf) == 4:
+        _, time_cost, memory_cost, parallelism = kdf
+        if (
+            1 <= time_cost <= ARGON2_MAX_TIME_COST
+            and 1 <= parallelism <= ARGON2_MAX_PARALLELISM
+            and 8 * parallelism <= memory_cost <= ARGON2_MAX_MEMORY_COST
+        ):
+            return
+    raise ValueError("Invalid encrypted data: key derivation parameters out of range")
+
+
+def _pack_kdf(kdf: Kdf) -> bytes:
+    """编码 KDF 参数字段"""
+    if kdf[0] == _KDF_ARGON2:
+        return _ARGON2_PARAMS.pack(*kdf[1:])
+    return _PBKDF2_PARAMS.pack(kdf[1])
+
+
+def _unpack_kdf(kdf_id: int, data: memoryview) -> tuple[Kdf, int]:
+    """解析 KDF 参数字段，返回 (kdf, 参数字段长度)"""
+    if kdf_id == _KDF_PBKDF2 and len(data) >= _PBKDF2_PARAMS.size:
+        kdf: Kdf = (_KDF_PBKDF2, *_PBKDF2_PARAMS.unpack_from(data))
+        _validate_kdf(kdf)
+        return kdf, _PBKDF2_PARAMS.size
+    if kdf_id == _KDF_ARGON2 and len(data) >= _ARGON2_PARAMS.size:
+        kdf = (_KDF_ARGON2, *_ARGON2_PARAMS.unpack_from(data))
+        _validate_kdf(kdf)
+        return kdf, _ARGON2_PARAMS.size
+    raise ValueError("Invalid encrypted data: bad key derivation header")
+
+
+def clear_key_cache() -> None:
+    """清空派生密钥缓存和会话 salt (密码变更时调用)"""
+    _KEY_CACHE.clear()
+    _SESSION.clear()
+
+
+def encrypt(
+    plaintext: bytes,
+    password: str,
+    algorithm: int | None = None,
+    kdf: Kdf | None = None,
+) -> bytes:
+    """加密数据，返回 magic + version + header + salt + nonce + ciphertext + tag
 
     Args:
         plaintext: 待加密的明文字节
         password: master password
+        algorithm: 算法标识，默认按 CPU 能力自动选择
+        kdf: KDF 描述，默认使用 default_kdf()
 
     Returns:
-        加密后的字节: salt(16) + nonce(12) + ciphertext_with_tag
+        加密后的字节: magic(6) + version(1) + header(1) + kdf params
+        + salt(16) + nonce(12) + ciphertext_with_tag
     """
-    salt = os.urandom(SALT_SIZE)
-    nonce = os.urandom(NONCE_SIZE)
-    key = derive_key(password, salt)
-    aesgcm = AESGCM(key)
-    # GCM 模式的 encrypt 返回 ciphertext + tag(16 bytes)
-    ciphertext_with_tag = aesgcm.encrypt(nonce, plaintext, None)
-    return salt + nonce + ciphertext_with_tag
+    if algorithm is None:
+        algorithm = default_algorithm()
+    if algorithm not in _ALGORITHMS:
+        raise ValueError(f"Unsupported algorithm: {algorithm}")
+
+    # 同一会话内复用 salt (密钥已缓存)，但 nonce 每次必须重新生成；
+    # 会话 KDF 不是当前默认值时 (如旧格式文件) 重新派生，使旧文件升级
+    kdf = kdf if kdf is not None else default_kdf()
+    session = _SESSION.get(password)
+    if session is not None and session[1] == kdf:
+        salt = session[0]
+        nonce = os.urandom(NONCE_SIZE)
+    else:
+        # salt 和 nonce 一次取出，只进入内核一次
+        rand = os.urandom(SALT_SIZE + NONCE_SIZE)
+        salt, nonce = rand[:SALT_SIZE], rand[SALT_SIZE:]
+        _validate_kdf(kdf)
+        _SESSION[password] = (salt, kdf)
+    params = _pack_kdf(kdf)
+
+    # 预分配输出缓冲区，各段直接写入，避免多次拼接
+    magic = len(_MAGIC)
+    prefix = magic + 2 + len(params)
+    header = prefix + SALT_SIZE + NONCE_SIZE
+    out = bytearray(header + len(plaintext) + TAG_SIZE)
+    out[:magic] = _MAGIC
+    out[magic] = _FORMAT_VERSION
+    out[magic + 1] = kdf[0] << 4 | algorithm
+    out[magic + 2 : prefix] = params
+    out[prefix : prefix + SALT_SIZE] = salt
+    out[prefix + SALT_SIZE : header] = nonce
+    if algorithm == _ALG_CHACHA:
+        chacha = ChaCha20Poly1305(derive_key(password, salt, kdf))
+        out[header:] = chacha.encrypt(nonce, plaintext, None)
+    else:
+        encryptor = Cipher(
+            _get_algorithm(password, salt, kdf), modes.GCM(nonce)
+        ).encryptor()
+        # update_into 直接写入 out；尾部预留的 tag 空间满足其对余量的要求
+        encryptor.update_into(plaintext, memoryview(out)[header:])
+        encryptor.finalize()
+        out[-TAG_SIZE:] = encryptor.tag
+    return bytes(out)
 
 
 def decrypt(data: bytes, password: str) -> bytes:
@@ -65,18 +348,155 @@ def decrypt(data: bytes, password: str) -> bytes:
 
     Raises:
         ValueError: 密码错误或数据被篡改
+        RuntimeError: 文件使用 Argon2id 但未安装 argon2-cffi
     """
-    if len(data) < SALT_SIZE + NONCE_SIZE + 16:
+    algorithm, kdf, body = _parse_header(data)
+    return _decrypt_body(algorithm, kdf, body, password)
+
+
+def _parse_header(data: bytes) -> tuple[int, Kdf, memoryview]:
+    """解析文件头，返回 (算法, kdf, salt 起的数据)
+
+    以 magic 开头的按当前格式严格解析；否则按无头旧格式 (AES-256-GCM +
+    PBKDF2) 处理，两者不会互相回退。
+    """
+    # memoryview 切片不复制数据
+    mv = memoryview(data)
+    magic = len(_MAGIC)
+    if mv[:magic] != _MAGIC:
+        body = mv
+        algorithm, kdf = _ALG_AES_GCM, _LEGACY_KDF
+    else:
+        if len(mv) < magic + 2 or mv[magic] != _FORMAT_VERSION:
+            raise ValueError("Invalid encrypted data: unsupported format version")
+        algorithm, kdf_id = mv[magic + 1] & 0x0F, mv[magic + 1] >> 4
+        if algorithm not in _ALGORITHMS:
+            raise ValueError(f"Unsupported algorithm: {algorithm}")
+        kdf, size = _unpack_kdf(kdf_id, mv[magic + 2 :])
+        body = mv[magic + 2 + size :]
+    if len(body) < SALT_SIZE + NONCE_SIZE + TAG_SIZE:
         raise ValueError("Invalid encrypted data: too short")
+    return algorithm, kdf, body
 
-    salt = data[:SALT_SIZE]
-    nonce = data[SALT_SIZE : SALT_SIZE + NONCE_SIZE]
-    ciphertext_with_tag = data[SALT_SIZE + NONCE_SIZE :]
 
-    key = derive_key(password, salt)
-    aesgcm = AESGCM(key)
+def _decrypt_body(
+    algorithm: int, kdf: Kdf, data: memoryview, password: str
+) -> bytes:
+    """解密 salt + nonce + ciphertext + tag"""
+    salt = bytes(data[:SALT_SIZE])
+    nonce = bytes(data[SALT_SIZE : SALT_SIZE + NONCE_SIZE])
+    ciphertext_with_tag = data[SALT_SIZE + NONCE_SIZE :]
+    key, aes = _get_cached(password, salt, kdf)
 
     try:
-        return aesgcm.decrypt(nonce, ciphertext_with_tag, None)
+        plaintext = _aead_decrypt(algorithm, key, aes, nonce, ciphertext_with_tag)
     except Exception:
+        _KEY_CACHE.pop((salt, password, kdf), None)
         raise ValueError("解密失败：密码错误或数据已损坏")
+    _SESSION[password] = (salt, kdf)
+    return plaintext
+
+
+def _aead_decrypt(
+    algorithm: int,
+    key: bytes,
+    aes: algorithms.AES,
+    nonce: bytes,
+    ciphertext_with_tag: memoryview,
+    associated_data: bytes | None = None,
+) -> bytes:
+    """按算法解密并校验 ciphertext + tag，失败时抛出底层异常"""
+    if algorithm == _ALG_CHACHA:
+        chacha = ChaCha20Poly1305(key)
+        return chacha.decrypt(nonce, ciphertext_with_tag, associated_data)
+    decryptor = Cipher(
+        aes, modes.GCM(nonce, bytes(ciphertext_with_tag[-TAG_SIZE:]))
+    ).decryptor()
+    if associated_data is not None:
+        decryptor.authenticate_additional_data(associated_data)
+    return decryptor.update(ciphertext_with_tag[:-TAG_SIZE]) + decryptor.finalize()
+
+
+def _record_context(
+    snapshot: bytes, password: str
+) -> tuple[int, bytes, algorithms.AES, bytes]:
+    """返回快照的 (算法, 密钥, AES 对象, tag)，供日志记录使用"""
+    algorithm, kdf, body = _parse_header(snapshot)
+    key, aes = _get_cached(password, bytes(body[:SALT_SIZE]), kdf)
+    return algorithm, key, aes, bytes(body[-TAG_SIZE:])
+
+
+def seal_record(snapshot: bytes, seq: int, plaintext: bytes, password: str) -> bytes:
+    """加密一条追加到快照之后的日志记录
+
+    Args:
+        snapshot: 当前快照 (encrypt() 的输出)
+        seq: 记录序号，从 0 开始
+        plaintext: 记录明文
+        password: master password
+
+    Returns:
+        length(4) + nonce(12) + ciphertext + tag(16)；seq 为 0 时前面加上
+        日志头 (快照 tag)
+
+    Raises:
+        ValueError: 快照格式无效
+    """
+    algorithm, key, aes, snapshot_tag = _record_context(snapshot, password)
+    associated_data = snapshot_tag + _RECORD_SEQ.pack(seq)
+    nonce = os.urandom(NONCE_SIZE)
+    if algorithm == _ALG_CHACHA:
+        body = ChaCha20Poly1305(key).encrypt(nonce, plaintext, associated_data)
+    else:
+        encryptor = Cipher(aes, modes.GCM(nonce)).encryptor()
+        encryptor.authenticate_additional_data(associated_data)
+        body = encryptor.update(plaintext) + encryptor.finalize() + encryptor.tag
+    record = _RECORD_LEN.pack(NONCE_SIZE + len(body)) + nonce + body
+    if seq == 0:
+        return snapshot_tag + record
+    return record
+
+
+def open_records(
+    snapshot: bytes, log: bytes, password: str
+) -> tuple[list[bytes], int]:
+    """解密快照之后的日志记录
+
+    长度超出文件末尾的记录视为写入不完整，停止解析；日志头与快照 tag 不一致时
+    视为旧快照遗留的日志 (压缩过程中断)，整体忽略。
+
+    Returns:
+        (记录明文列表, 已解析的日志长度)；日志不属于该快照时为 ([], 0)。
+        长度小于 len(log) 表示末尾有未能解析的数据
+
+    Raises:
+        ValueError: 快照格式无效，或日志记录无法通过校验
+    """
+    algorithm, key, aes, snapshot_tag = _record_context(snapshot, password)
+    if len(log) < TAG_SIZE or log[:TAG_SIZE] != snapshot_tag:
+        return [], 0
+
+    mv = memoryview(log)
+    records: list[bytes] = []
+    offset = TAG_SIZE
+    while offset + _RECORD_LEN.size <= len(mv):
+        (length,) = _RECORD_LEN.unpack_from(mv, offset)
+        start = offset + _RECORD_LEN.size
+        end = start + length
+        if length < NONCE_SIZE + TAG_SIZE:
+            raise ValueError("解密失败：凭证日志已损坏")
+        if end > len(mv):
+            break
+        nonce = bytes(mv[start : start + NONCE_SIZE])
+        associated_data = snapshot_tag + _RECORD_SEQ.pack(len(records))
+        try:
+            records.append(
+                _aead_decrypt(
+                    algorithm, key, aes, nonce,
+                    mv[start + NONCE_SIZE : end], associated_data,
+                )
+            )
+        except Exception:
+            raise ValueError("解密失败：凭证日志已损坏")
+        offset = end
+    return records, offset
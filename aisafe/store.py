@@ -2,29 +2,72 @@
 Core credential store — read and write TOML-based credentials.
 
 Supports both plaintext (.toml) and encrypted (.toml.enc) storage.
-Encrypted mode uses AES-256-GCM with PBKDF2 key derivation.
+Encrypted mode uses AES-256-GCM (or ChaCha20-Poly1305) with Argon2id
+(when argon2-cffi is installed) or PBKDF2 key derivation.
+
+In encrypted mode, set() and remove() append a small authenticated record
+to a log file (.toml.log.enc) next to the snapshot instead of re-encrypting
+the whole store. The log is replayed on load and folded back into the
+snapshot (compaction) once it outgrows it, or on any full save. Appends
+and encrypted saves hold an exclusive lock on a .toml.lock file, so
+several processes never write the log at the same time.
 """
 
 from __future__ import annotations
 
+import functools
 import os
-import tomllib
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterator
 
-from .paths import get_credentials_path, ensure_config_dir
+from .paths import get_credentials_path
 
 
 _cache: dict[str, Any] | None = None
+# Resolved get() results; cleared together with _cache and on every mutation
+_value_cache: dict[str, Any] = {}
+_MISSING = object()
+_EMPTY: dict[str, Any] = {}
 _custom_path: Path | None = None
+# (plain, encrypted, log, lock file) paths and the AISAFE_FILE value they were built from
+_path_cache: tuple[Path, Path, Path, Path] | None = None
+_path_env: str | None = None
+# Directory already known to exist, so _ensure_dir() can skip mkdir
+_ready_dir: Path | None = None
 _master_password: str | None = None
+_in_txn: bool = False
+# set()/remove() mutate the cached dict in place; serialize them so a
+# concurrent save never iterates a dict that is being modified
+_lock = threading.RLock()
+_dirty: bool = False
+# Raw encrypted snapshot the log records are bound to (None in plaintext mode)
+_snapshot: bytes | None = None
+# (records in log, valid log size, snapshot (size, mtime)) as last seen by us
+_log_state: tuple[int, int, tuple[int, int]] | None = None
+
+# TOML basic strings: escape backslash, quote and every control character
+_ESCAPE_TABLE = str.maketrans({
+    **{chr(c): f"\\u{c:04x}" for c in [*range(0x20), 0x7F]},
+    "\b": "\\b",
+    "\t": "\\t",
+    "\n": "\\n",
+    "\f": "\\f",
+    "\r": "\\r",
+    "\\": "\\\\",
+    '"': '\\"',
+})
 
 
 def init(path: str | Path) -> None:
     """Set a custom credentials file path (overrides default and env var)."""
-    global _custom_path, _cache
+    global _custom_path, _path_cache
     _custom_path = Path(path).expanduser()
-    _cache = None
+    _path_cache = None
+    reload()
 
 
 def unlock(password: str) -> None:
@@ -36,9 +79,13 @@ def unlock(password: str) -> None:
     Args:
         password: The master password to decrypt credentials.
     """
-    global _master_password, _cache
+    global _master_password
+    if password != _master_password:
+        from .crypto import clear_key_cache
+
+        clear_key_cache()
     _master_password = password
-    _cache = None  # force reload with new password
+    reload()  # force reload with new password
 
 
 def _get_password() -> str | None:
@@ -48,16 +95,49 @@ def _get_password() -> str | None:
     return os.environ.get("AISAFE_KEY")
 
 
+def _resolve_paths() -> tuple[Path, Path, Path, Path]:
+    """Return the (plaintext, encrypted, encrypted log, lock) credentials file paths.
+
+    Cached until init() is called or AISAFE_FILE changes.
+    """
+    global _path_cache, _path_env
+    env = os.environ.get("AISAFE_FILE") if _custom_path is None else None
+    if _path_cache is None or env != _path_env:
+        path = _custom_path if _custom_path is not None else get_credentials_path()
+        _path_cache = (
+            path,
+            path.with_suffix(".toml.enc"),
+            path.with_suffix(".toml.log.enc"),
+            path.with_suffix(".toml.lock"),
+        )
+        _path_env = env
+    return _path_cache
+
+
+def _get_paths() -> tuple[Path, Path]:
+    """Return the (plaintext, encrypted) credentials file paths."""
+    plain_path, enc_path, _, _ = _resolve_paths()
+    return plain_path, enc_path
+
+
 def _get_path() -> Path:
     """Return the active credentials file path."""
-    if _custom_path is not None:
-        return _custom_path
-    return get_credentials_path()
+    return _get_paths()[0]
 
 
 def _get_enc_path() -> Path:
     """Return the encrypted credentials file path."""
-    return _get_path().with_suffix(".toml.enc")
+    return _resolve_paths()[1]
+
+
+def _get_log_path() -> Path:
+    """Return the encrypted log file path."""
+    return _resolve_paths()[2]
+
+
+def _get_lock_path() -> Path:
+    """Return the lock file path guarding log appends and encrypted saves."""
+    return _resolve_paths()[3]
 
 
 def is_encrypted() -> bool:
@@ -71,8 +151,9 @@ def _load() -> dict[str, Any]:
     if _cache is not None:
         return _cache
 
-    enc_path = _get_enc_path()
-    plain_path = _get_path()
+    import tomllib
+
+    plain_path, enc_path = _get_paths()
 
     if enc_path.exists():
         # Encrypted mode
@@ -86,11 +167,12 @@ def _load() -> dict[str, Any]:
 
         raw = enc_path.read_bytes()
         plaintext = decrypt(raw, password)
-        _cache = tomllib.loads(plaintext.decode("utf-8"))
+        data = tomllib.loads(plaintext.decode("utf-8"))
+        _replay_log(data, raw, password)
+        _cache = data
     elif plain_path.exists():
         # Plaintext mode
-        with open(plain_path, "rb") as f:
-            _cache = tomllib.load(f)
+        _cache = tomllib.loads(plain_path.read_bytes().decode("utf-8"))
     else:
         _cache = {}
 
@@ -98,9 +180,258 @@ def _load() -> dict[str, Any]:
 
 
 def _save(data: dict[str, Any]) -> None:
-    """Write the credential data back (plaintext or encrypted)."""
-    ensure_config_dir()
+    """Write the credential data back and keep it as the cache.
 
+    The dict is already in the exact state that was written, so there is
+    no need to re-read and re-parse the file on the next access.
+    """
+    global _cache
+    try:
+        _write(data)
+    except BaseException:
+        reload()  # in-memory data may no longer match the file
+        raise
+    _cache = data
+
+
+def _commit(data: dict[str, Any], key: str, value: Any = _MISSING) -> None:
+    """Persist one set (or remove, if value is _MISSING) of an in-place change.
+
+    Appends a log record when possible, otherwise saves the whole store.
+    Inside a transaction() the write is deferred to the end of the block.
+    """
+    global _dirty
+    _value_cache.clear()
+    if _in_txn:
+        _dirty = True
+        return
+    try:
+        appended = _append(key, value)
+    except BaseException:
+        reload()  # in-memory data may no longer match the file
+        raise
+    if not appended:
+        _save(data)
+
+
+def _file_id(path: Path) -> tuple[int, int]:
+    """Return (size, mtime) used to notice a file changed behind our back."""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+def _log_error(log_path: Path) -> ValueError:
+    """Build the error for a log that cannot be replayed, with the way out."""
+    return ValueError(
+        f"凭证日志已损坏: {log_path}\n"
+        "删除该文件即可读取快照，只会丢失上次完整保存之后的修改"
+    )
+
+
+def _replay_log(data: dict[str, Any], snapshot: bytes, password: str) -> None:
+    """Apply the records in the encrypted log on top of the snapshot data."""
+    global _snapshot, _log_state
+    import tomllib
+
+    from .crypto import open_records
+
+    log_path = _get_log_path()
+    try:
+        log = log_path.read_bytes()
+    except FileNotFoundError:
+        log = b""
+    try:
+        records, size = open_records(snapshot, log, password) if log else ([], 0)
+        for record in records:
+            op = tomllib.loads(record.decode("utf-8"))
+            section, field = _split(op["key"])
+            if op["op"] == "set":
+                _apply_set(data, section, field, op["value"])
+            else:
+                _apply_remove(data, section, field)
+    except (ValueError, KeyError, TypeError):
+        raise _log_error(log_path) from None
+
+    _snapshot = snapshot
+    # A log without complete records is rewritten from scratch (header included)
+    _log_state = (len(records), size if records else 0, _file_id(_get_enc_path()))
+
+
+def _check_log(password: str, snapshot: bytes | None = None) -> None:
+    """Refuse to fold away a log that has bytes we could not parse.
+
+    A stale log from an interrupted compaction may be dropped, but a log
+    for the current snapshot must parse to its last byte: anything after a
+    torn or corrupt record would otherwise be lost for good.
+    """
+    from .crypto import open_records
+
+    log_path = _get_log_path()
+    try:
+        log = log_path.read_bytes()
+        if snapshot is None:
+            snapshot = _get_enc_path().read_bytes()
+    except FileNotFoundError:
+        return
+    try:
+        _, size = open_records(snapshot, log, password)
+    except ValueError:
+        raise _log_error(log_path) from None
+    if size and size != len(log):
+        raise _log_error(log_path)
+
+
+def _append(key: str, value: Any) -> bool:
+    """Append a set/remove record to the encrypted log.
+
+    Returns False when the whole store has to be saved instead: plaintext
+    mode, a value a record cannot round-trip (anything but str, int, float
+    or bool), a log that has outgrown the snapshot (compaction), a log left
+    over from an interrupted compaction, or files changed by another
+    process or a torn append.
+    """
+    global _log_state
+    password = _get_password()
+    if _snapshot is None or _log_state is None or password is None:
+        return False
+    if value is not _MISSING and not isinstance(value, (str, int, float)):
+        return False
+    seq, size, snapshot_id = _log_state
+    if size > 2 * len(_snapshot):
+        return False
+
+    from .crypto import seal_record
+
+    fields = {"op": "set", "key": key, "value": value}
+    if value is _MISSING:
+        fields = {"op": "remove", "key": key}
+    plaintext = "".join(
+        [f"{name} = {_toml_value(val)}\n" for name, val in fields.items()]
+    ).encode("utf-8")
+
+    log_path = _get_log_path()
+    # Checked under the lock: another process appending between the check
+    # and our write would reuse our sequence number and break the log
+    with _file_lock():
+        try:
+            log_size = os.stat(log_path).st_size
+        except FileNotFoundError:
+            log_size = 0
+        if log_size != size or _file_id(_get_enc_path()) != snapshot_id:
+            return False
+        try:
+            record = seal_record(_snapshot, seq, plaintext, password)
+        except ValueError:
+            return False
+
+        fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        _log_state = (seq + 1, size + len(record), snapshot_id)
+    return True
+
+
+@contextmanager
+def _file_lock() -> Iterator[None]:
+    """Hold an exclusive lock on the store's lock file, across processes."""
+    lock_path = _get_lock_path()
+    _ensure_dir(lock_path)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if sys.platform == "win32":
+            import msvcrt
+
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # releases the lock
+
+
+def _wrote_snapshot(snapshot: bytes | None) -> None:
+    """Drop the log after a full save; it is folded into the new snapshot."""
+    global _snapshot, _log_state
+    _get_log_path().unlink(missing_ok=True)
+    _snapshot = snapshot
+    _log_state = None
+    if snapshot is not None:
+        _log_state = (0, 0, _file_id(_get_enc_path()))
+
+
+@contextmanager
+def transaction() -> Iterator[None]:
+    """Batch several set()/remove() calls into a single write.
+
+    Changes are applied in memory and written once when the block exits.
+    If the block raises, pending changes are discarded. Other threads'
+    set()/remove() calls block until the transaction ends.
+
+    Usage:
+        with aisafe.transaction():
+            for key, value in secrets.items():
+                aisafe.set(key, value)
+    """
+    global _in_txn, _dirty
+    # Held for the whole block: other threads' set()/remove() wait instead
+    # of being deferred into (and discarded with) this transaction
+    with _lock:
+        if _in_txn:
+            # Nested: the outermost transaction does the write
+            yield
+            return
+
+        _in_txn = True
+        _dirty = False
+        try:
+            yield
+        except BaseException:
+            _in_txn = False
+            if _dirty:
+                reload()
+            _dirty = False
+            raise
+        _in_txn = False
+        if _dirty:
+            _dirty = False
+            _save(_load())
+
+
+def _ensure_dir(path: Path) -> None:
+    """Create the parent directory of path unless already known to exist."""
+    global _ready_dir
+    if path.parent != _ready_dir:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        _ready_dir = path.parent
+
+
+def _atomic_write(path: Path, data: bytes) -> None:
+    """Write a file atomically: temp file in the same directory, fsync, rename.
+
+    A crash mid-write leaves the previous file intact instead of a
+    truncated credential store. mkstemp() creates the file with mode 0600.
+    """
+    _ensure_dir(path)
+    # Unique name, so concurrent saves never share (and truncate) one temp file
+    fd, name = tempfile.mkstemp(dir=path.parent, prefix=path.name + ".")
+    tmp = Path(name)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+
+def _write(data: dict[str, Any]) -> None:
+    """Write the credential data to disk (plaintext or encrypted)."""
     toml_bytes = _serialize_toml(data).encode("utf-8")
     enc_path = _get_enc_path()
 
@@ -114,30 +445,30 @@ def _save(data: dict[str, Any]) -> None:
             )
         from .crypto import encrypt
 
-        enc_path.write_bytes(encrypt(toml_bytes, password))
+        snapshot = encrypt(toml_bytes, password)
+        with _file_lock():
+            _check_log(password)
+            _atomic_write(enc_path, snapshot)
+            _wrote_snapshot(snapshot)
         # Remove plaintext file if it exists
         plain_path = _get_path()
         if plain_path.exists():
             plain_path.unlink()
     else:
         # Plaintext mode
-        _get_path().write_text(
-            toml_bytes.decode("utf-8"), encoding="utf-8"
-        )
+        _atomic_write(_get_path(), toml_bytes)
+        _wrote_snapshot(None)
 
 
 def _serialize_toml(data: dict[str, Any]) -> str:
     """Serialize data to TOML format."""
-    lines: list[str] = []
-    for section, values in data.items():
-        if isinstance(values, dict):
-            lines.append(f"[{section}]")
-            for key, val in values.items():
-                lines.append(f"{key} = {_toml_value(val)}")
-            lines.append("")
-        else:
-            lines.append(f"{section} = {_toml_value(values)}")
-    return "\n".join(lines) + "\n"
+    return "\n".join([
+        f"[{section}]\n"
+        + "".join([f"{key} = {_toml_value(val)}\n" for key, val in values.items()])
+        if isinstance(values, dict)
+        else f"{section} = {_toml_value(values)}"
+        for section, values in data.items()
+    ]) + "\n"
 
 
 def _toml_value(val: Any) -> str:
@@ -149,16 +480,26 @@ def _toml_value(val: Any) -> str:
     elif isinstance(val, float):
         return str(val)
     elif isinstance(val, str):
-        escaped = val.replace("\\", "\\\\").replace('"', '\\"')
-        return f'"{escaped}"'
+        return f'"{val.translate(_ESCAPE_TABLE)}"'
     else:
         return f'"{val}"'
 
 
 def reload() -> None:
     """Clear cache and force reload on next access."""
-    global _cache
-    _cache = None
+    global _cache, _snapshot, _log_state
+    with _lock:
+        _cache = None
+        _snapshot = None
+        _log_state = None
+        _value_cache.clear()
+
+
+@functools.lru_cache(maxsize=256)
+def _split(key: str) -> tuple[str, str | None]:
+    """Split 'section.field' into (section, field); field is None for top-level keys."""
+    section, sep, field = key.partition(".")
+    return (section, field) if sep else (section, None)
 
 
 def get(key: str, default: Any = None) -> Any:
@@ -168,12 +509,21 @@ def get(key: str, default: Any = None) -> Any:
         key: Dot-separated key, e.g. 'database.password'.
         default: Value to return if key is not found.
     """
-    data = _load()
-    parts = key.split(".", 1)
-    if len(parts) == 2:
-        section, field = parts
-        return data.get(section, {}).get(field, default)
-    return data.get(parts[0], default)
+    value = _value_cache.get(key, _MISSING)
+    if value is _MISSING:
+        section, field = _split(key)
+        # Fill under the lock so a concurrent set()/remove() cannot clear the
+        # cache between our read and our store, leaving a stale value behind
+        with _lock:
+            data = _load()
+            if field is None:
+                value = data.get(section, _MISSING)
+            else:
+                value = data.get(section, _EMPTY).get(field, _MISSING)
+            if value is _MISSING:
+                return default
+            _value_cache[key] = value
+    return value
 
 
 def get_section(section: str) -> dict[str, Any]:
@@ -185,47 +535,48 @@ def get_section(section: str) -> dict[str, Any]:
 
 def set(key: str, value: Any) -> None:
     """Set a credential value."""
-    data = _load().copy()
-    parts = key.split(".", 1)
+    section, field = _split(key)
+    with _lock:
+        data = _load()
+        _apply_set(data, section, field, value)
+        _commit(data, key, value)
 
-    if len(parts) == 2:
-        section, field = parts
-        if section not in data:
-            data[section] = {}
-        elif not isinstance(data[section], dict):
+
+def remove(key: str) -> bool:
+    """Remove a credential value."""
+    section, field = _split(key)
+    with _lock:
+        data = _load()
+        if _apply_remove(data, section, field):
+            _commit(data, key)
+            return True
+
+    return False
+
+
+def _apply_set(data: dict[str, Any], section: str, field: str | None, value: Any) -> None:
+    """Set a value in the credential dict in place."""
+    if field is not None:
+        if not isinstance(data.get(section), dict):
             data[section] = {}
-        data[section] = dict(data[section])
         data[section][field] = value
     else:
-        data[parts[0]] = value
+        data[section] = value
 
-    _save(data)
-    reload()
-
-
-def remove(key: str) -> bool:
-    """Remove a credential value."""
-    data = _load().copy()
-    parts = key.split(".", 1)
 
-    if len(parts) == 2:
-        section, field = parts
+def _apply_remove(data: dict[str, Any], section: str, field: str | None) -> bool:
+    """Remove a value from the credential dict in place; False if absent."""
+    if field is not None:
         if section in data and isinstance(data[section], dict):
-            data[section] = dict(data[section])
             if field in data[section]:
                 del data[section][field]
                 if not data[section]:
                     del data[section]
-                _save(data)
-                reload()
                 return True
     else:
-        if parts[0] in data:
-            del data[parts[0]]
-            _save(data)
-            reload()
+        if section in data:
+            del data[section]
             return True
-
     return False
 
 
@@ -264,22 +615,23 @@ def encrypt_store(password: str) -> None:
     if not plain_path.exists():
         raise FileNotFoundError(f"明文凭证文件不存在: {plain_path}")
 
-    with open(plain_path, "rb") as f:
-        data = f.read()
+    data = plain_path.read_bytes()
 
     from .crypto import encrypt as crypto_encrypt
 
     enc_path = _get_enc_path()
-    enc_path.write_bytes(crypto_encrypt(data, password))
+    snapshot = crypto_encrypt(data, password)
+    _atomic_write(enc_path, snapshot)
+    _wrote_snapshot(snapshot)
     plain_path.unlink()
     _master_password = password
-    reload()
 
 
 def decrypt_store(password: str) -> None:
     """Decrypt the credential file back to plaintext.
 
-    Reads the encrypted file, decrypts it, and writes plaintext TOML.
+    Reads the encrypted file, decrypts it (replaying any log records),
+    and writes plaintext TOML.
     """
     global _master_password
     enc_path = _get_enc_path()
@@ -288,11 +640,19 @@ def decrypt_store(password: str) -> None:
 
     from .crypto import decrypt as crypto_decrypt
 
-    raw = enc_path.read_bytes()
-    plaintext = crypto_decrypt(raw, password)
+    with _file_lock():
+        raw = enc_path.read_bytes()
+        plaintext = crypto_decrypt(raw, password)
+        if _get_log_path().exists():
+            import tomllib
+
+            data = tomllib.loads(plaintext.decode("utf-8"))
+            _replay_log(data, raw, password)
+            _check_log(password, raw)
+            plaintext = _serialize_toml(data).encode("utf-8")
 
-    plain_path = _get_path()
-    plain_path.write_bytes(plaintext)
-    enc_path.unlink()
+        plain_path = _get_path()
+        _atomic_write(plain_path, plaintext)
+        enc_path.unlink()
+        _wrote_snapshot(None)
     _master_password = None
-    reload()
@@ -0,0 +1,23 @@
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from aisafe import crypto, store
+
+
+@pytest.fixture(autouse=True)
+def credentials(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Iterator[Path]:
+    """Point the store at a fresh credentials file and reset its state."""
+    path = tmp_path / "credentials.toml"
+    monkeypatch.setenv("AISAFE_FILE", str(path))
+    monkeypatch.setenv("XDG_CONFIG_HOME", str(tmp_path / "config"))
+    monkeypatch.delenv("AISAFE_KEY", raising=False)
+    monkeypatch.setattr(store, "_custom_path", None)
+    monkeypatch.setattr(store, "_path_cache", None)
+    monkeypatch.setattr(store, "_master_password", None)
+    crypto.clear_key_cache()
+    store.reload()
+    yield path
+    crypto.clear_key_cache()
+    store.reload()
@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import pytest
+
+from aisafe import cli, store
+
+
+def test_read_batch_keeps_values_verbatim(tmp_path: Path) -> None:
+    path = tmp_path / "batch.txt"
+    path.write_bytes(
+        "# comment\n\na.x= spaced \r\na.y=form\ffeed sep\na.z=cr\rmid\n".encode()
+    )
+    assert cli._read_batch(str(path)) == [
+        ("a.x", " spaced "),
+        ("a.y", "form\ffeed sep"),
+        ("a.z", "cr\rmid"),
+    ]
+
+
+def test_read_batch_rejects_bad_line(tmp_path: Path) -> None:
+    path = tmp_path / "batch.txt"
+    path.write_text("a.x=1\nnot a pair\n")
+    with pytest.raises(SystemExit):
+        cli._read_batch(str(path))
+
+
+def test_set_batch(tmp_path: Path) -> None:
+    path = tmp_path / "batch.txt"
+    path.write_text("a.x=1\na.y=hello\fworld\n")
+    cli.main(["set", "--batch", str(path)])
+    store.reload()
+    assert store.get("a.x") == "1"
+    assert store.get("a.y") == "hello\fworld"
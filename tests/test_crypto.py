@@ -0,0 +1,171 @@
+import hashlib
+import os
+import struct
+
+import pytest
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from aisafe import crypto
+
+requires_argon2 = pytest.mark.skipif(
+    not crypto._HAS_ARGON2, reason="argon2-cffi not installed"
+)
+
+PBKDF2_KDF = (crypto._KDF_PBKDF2, crypto.PBKDF2_ITERATIONS)
+ARGON2_KDF = (
+    crypto._KDF_ARGON2,
+    crypto.ARGON2_TIME_COST,
+    crypto.ARGON2_MEMORY_COST,
+    crypto.ARGON2_PARALLELISM,
+)
+MAGIC = len(crypto._MAGIC)
+
+
+def legacy_encrypt(plaintext: bytes, password: str) -> bytes:
+    """Build a headerless file the way aisafe 0.1 wrote them."""
+    salt, nonce = os.urandom(crypto.SALT_SIZE), os.urandom(crypto.NONCE_SIZE)
+    key = hashlib.pbkdf2_hmac(
+        "sha256", password.encode(), salt, crypto.PBKDF2_ITERATIONS, dklen=32
+    )
+    return salt + nonce + AESGCM(key).encrypt(nonce, plaintext, None)
+
+
+def test_round_trip() -> None:
+    data = crypto.encrypt(b"secret", "pw")
+    assert data.startswith(crypto._MAGIC)
+    assert crypto.decrypt(data, "pw") == b"secret"
+
+
+def test_wrong_password() -> None:
+    data = crypto.encrypt(b"secret", "pw")
+    crypto.clear_key_cache()
+    with pytest.raises(ValueError):
+        crypto.decrypt(data, "other")
+
+
+def test_tampered_ciphertext() -> None:
+    data = bytearray(crypto.encrypt(b"secret", "pw"))
+    data[-20] ^= 1
+    with pytest.raises(ValueError):
+        crypto.decrypt(bytes(data), "pw")
+
+
+def test_unsupported_version() -> None:
+    data = bytearray(crypto.encrypt(b"secret", "pw"))
+    data[MAGIC] = 99
+    with pytest.raises(ValueError, match="format version"):
+        crypto.decrypt(bytes(data), "pw")
+
+
+def test_legacy_headerless_file() -> None:
+    assert crypto.decrypt(legacy_encrypt(b"old", "pw"), "pw") == b"old"
+
+
+def test_legacy_file_upgraded_on_save() -> None:
+    crypto.decrypt(legacy_encrypt(b"old", "pw"), "pw")
+    data = crypto.encrypt(b"new", "pw")
+    kdf, _ = crypto._unpack_kdf(
+        data[MAGIC + 1] >> 4, memoryview(data)[MAGIC + 2 :]
+    )
+    assert kdf == crypto.default_kdf()
+    assert crypto.decrypt(data, "pw") == b"new"
+
+
+@pytest.mark.parametrize("algorithm", [crypto._ALG_AES_GCM, crypto._ALG_CHACHA])
+def test_algorithm_header(algorithm: int) -> None:
+    data = crypto.encrypt(b"secret", "pw", algorithm=algorithm, kdf=PBKDF2_KDF)
+    assert data[MAGIC + 1] == crypto._KDF_PBKDF2 << 4 | algorithm
+    crypto.clear_key_cache()
+    assert crypto.decrypt(data, "pw") == b"secret"
+
+
+def test_unsupported_algorithm() -> None:
+    data = bytearray(crypto.encrypt(b"secret", "pw", kdf=PBKDF2_KDF))
+    data[MAGIC + 1] = crypto._KDF_PBKDF2 << 4 | crypto._ALG_AEGIS256
+    with pytest.raises(ValueError, match="Unsupported algorithm"):
+        crypto.decrypt(bytes(data), "pw")
+
+
+def test_pbkdf2_header() -> None:
+    data = crypto.encrypt(b"secret", "pw", kdf=PBKDF2_KDF)
+    (iterations,) = struct.unpack_from(">I", data, MAGIC + 2)
+    assert iterations == crypto.PBKDF2_ITERATIONS
+    crypto.clear_key_cache()
+    assert crypto.decrypt(data, "pw") == b"secret"
+
+
+@requires_argon2
+def test_argon2_header() -> None:
+    data = crypto.encrypt(b"secret", "pw", kdf=ARGON2_KDF)
+    assert data[MAGIC + 1] >> 4 == crypto._KDF_ARGON2
+    assert struct.unpack_from(">BIB", data, MAGIC + 2) == ARGON2_KDF[1:]
+    crypto.clear_key_cache()
+    assert crypto.decrypt(data, "pw") == b"secret"
+
+
+def test_pbkdf2_iterations_out_of_range() -> None:
+    data = bytearray(crypto.encrypt(b"secret", "pw", kdf=PBKDF2_KDF))
+    struct.pack_into(">I", data, MAGIC + 2, 1)
+    with pytest.raises(ValueError, match="out of range"):
+        crypto.decrypt(bytes(data), "pw")
+    struct.pack_into(">I", data, MAGIC + 2, crypto.PBKDF2_MAX_ITERATIONS + 1)
+    with pytest.raises(ValueError, match="out of range"):
+        crypto.decrypt(bytes(data), "pw")
+
+
+@requires_argon2
+def test_argon2_params_out_of_range() -> None:
+    data = bytearray(crypto.encrypt(b"secret", "pw", kdf=ARGON2_KDF))
+    struct.pack_into(">BIB", data, MAGIC + 2, 1, crypto.ARGON2_MAX_MEMORY_COST + 1, 1)
+    with pytest.raises(ValueError, match="out of range"):
+        crypto.decrypt(bytes(data), "pw")
+
+
+def test_encrypt_rejects_out_of_range_kdf() -> None:
+    with pytest.raises(ValueError, match="out of range"):
+        crypto.encrypt(b"secret", "pw", kdf=(crypto._KDF_PBKDF2, 1000))
+
+
+def make_log(snapshot: bytes, *records: bytes) -> bytes:
+    return b"".join(
+        crypto.seal_record(snapshot, seq, record, "pw")
+        for seq, record in enumerate(records)
+    )
+
+
+def test_records_round_trip() -> None:
+    snapshot = crypto.encrypt(b"", "pw")
+    log = make_log(snapshot, b"one", b"two")
+    assert crypto.open_records(snapshot, log, "pw") == ([b"one", b"two"], len(log))
+
+
+def test_records_reordered() -> None:
+    snapshot = crypto.encrypt(b"", "pw")
+    first = crypto.seal_record(snapshot, 0, b"one", "pw")
+    second = crypto.seal_record(snapshot, 1, b"two", "pw")
+    third = crypto.seal_record(snapshot, 2, b"three", "pw")
+    with pytest.raises(ValueError):
+        crypto.open_records(snapshot, first + third + second, "pw")
+
+
+def test_records_torn_tail() -> None:
+    snapshot = crypto.encrypt(b"", "pw")
+    log = make_log(snapshot, b"one", b"two")
+    records, size = crypto.open_records(snapshot, log[:-5], "pw")
+    assert records == [b"one"]
+    assert size < len(log) - 5
+
+
+def test_records_bad_length() -> None:
+    snapshot = crypto.encrypt(b"", "pw")
+    log = bytearray(make_log(snapshot, b"one", b"two"))
+    struct.pack_into(">I", log, crypto.TAG_SIZE, 3)
+    with pytest.raises(ValueError):
+        crypto.open_records(snapshot, bytes(log), "pw")
+
+
+def test_records_from_other_snapshot_ignored() -> None:
+    old = crypto.encrypt(b"", "pw")
+    log = make_log(old, b"one")
+    new = crypto.encrypt(b"", "pw")
+    assert crypto.open_records(new, log, "pw") == ([], 0)
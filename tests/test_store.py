@@ -0,0 +1,203 @@
+import struct
+from pathlib import Path
+
+import pytest
+
+import aisafe
+from aisafe import crypto, store
+
+
+@pytest.fixture
+def encrypted(credentials: Path) -> Path:
+    """An encrypted store whose snapshot is large enough to take log appends."""
+    aisafe.unlock("pw")
+    aisafe.set("seed.padding", "x" * 1000)
+    assert store._get_enc_path().exists()
+    return store._get_log_path()
+
+
+def restart() -> None:
+    """Forget everything cached in memory, as a new process would."""
+    crypto.clear_key_cache()
+    store.reload()
+
+
+def record_offsets(log: bytes) -> list[int]:
+    offsets = []
+    offset = crypto.TAG_SIZE
+    while offset < len(log):
+        offsets.append(offset)
+        (length,) = struct.unpack_from(">I", log, offset)
+        offset += 4 + length
+    return offsets
+
+
+def test_plaintext_round_trip(credentials: Path) -> None:
+    aisafe.set("token", "abc")
+    aisafe.set("db.user", "admin")
+    aisafe.set("db.port", 5432)
+    restart()
+    assert aisafe.get("db.user") == "admin"
+    assert aisafe.get("db.port") == 5432
+    assert aisafe.get("token") == "abc"
+    assert aisafe.remove("db.user")
+    restart()
+    assert aisafe.get("db.user") is None
+
+
+def test_control_characters_round_trip(credentials: Path) -> None:
+    value = "a\fb\vc\rd\ne\x00f\x7fg\\h\"i"
+    aisafe.set("s.v", value)
+    restart()
+    assert aisafe.get("s.v") == value
+
+
+def test_log_replay(encrypted: Path) -> None:
+    aisafe.set("a.x", "1")
+    aisafe.set("a.y", 2)
+    aisafe.set("a.z", "line\nbreak\f")
+    aisafe.remove("a.x")
+    assert encrypted.exists()
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.x") is None
+    assert aisafe.get("a.y") == 2
+    assert aisafe.get("a.z") == "line\nbreak\f"
+
+
+def test_dict_value_saved_as_section(encrypted: Path) -> None:
+    aisafe.set("db", {"user": "x"})
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("db") == {"user": "x"}
+
+
+def test_compaction(encrypted: Path) -> None:
+    snapshot = store._get_enc_path().read_bytes()
+    for i in range(100):
+        aisafe.set(f"a.k{i}", str(i))
+    assert store._get_enc_path().read_bytes() != snapshot
+    assert encrypted.stat().st_size <= 2 * store._get_enc_path().stat().st_size
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.k99") == "99"
+
+
+def test_tampered_record(encrypted: Path) -> None:
+    aisafe.set("a.x", "1")
+    log = bytearray(encrypted.read_bytes())
+    log[-1] ^= 1
+    encrypted.write_bytes(log)
+    restart()
+    aisafe.unlock("pw")
+    with pytest.raises(ValueError, match="credentials.toml.log.enc"):
+        aisafe.get("a.x")
+
+
+def test_bad_record_length(encrypted: Path) -> None:
+    for key in ("a.x", "a.y", "a.z"):
+        aisafe.set(key, "1")
+    log = bytearray(encrypted.read_bytes())
+    struct.pack_into(">I", log, record_offsets(bytes(log))[1], 3)
+    encrypted.write_bytes(log)
+    restart()
+    aisafe.unlock("pw")
+    with pytest.raises(ValueError, match="credentials.toml.log.enc"):
+        aisafe.list_keys()
+
+
+def test_torn_tail_is_never_compacted_away(encrypted: Path) -> None:
+    aisafe.set("a.x", "1")
+    aisafe.set("a.y", "2")
+    log = encrypted.read_bytes()[:-5]
+    encrypted.write_bytes(log)
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.x") == "1"
+    assert aisafe.get("a.y") is None
+    with pytest.raises(ValueError, match="credentials.toml.log.enc"):
+        aisafe.set("a.z", "3")
+    assert encrypted.read_bytes() == log
+    with pytest.raises(ValueError, match="credentials.toml.log.enc"):
+        aisafe.decrypt_store("pw")
+    assert store._get_enc_path().exists()
+
+
+def test_stale_log_after_compaction(encrypted: Path) -> None:
+    aisafe.set("a.x", "old")
+    stale = encrypted.read_bytes()
+    with aisafe.transaction():
+        aisafe.set("a.x", "new")  # full save folds the log away
+    assert not encrypted.exists()
+    encrypted.write_bytes(stale)  # as if the unlink was interrupted
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.x") == "new"
+    aisafe.set("a.y", "1")
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.x") == "new"
+    assert aisafe.get("a.y") == "1"
+
+
+def test_decrypt_store_replays_log(encrypted: Path) -> None:
+    aisafe.set("a.x", "1")
+    aisafe.decrypt_store("pw")
+    assert not encrypted.exists()
+    assert not store._get_enc_path().exists()
+    restart()
+    assert aisafe.get("a.x") == "1"
+
+
+def test_legacy_store_takes_appends(credentials: Path) -> None:
+    from test_crypto import legacy_encrypt
+
+    store._get_enc_path().write_bytes(legacy_encrypt(b'[a]\nx = "1"\n', "pw"))
+    aisafe.unlock("pw")
+    aisafe.set("a.y", "2")
+    restart()
+    aisafe.unlock("pw")
+    assert aisafe.get("a.x") == "1"
+    assert aisafe.get("a.y") == "2"
+
+
+def test_transaction_commits_once(credentials: Path) -> None:
+    with aisafe.transaction():
+        aisafe.set("a.x", "1")
+        aisafe.set("a.y", "2")
+        assert not credentials.exists()
+    restart()
+    assert aisafe.get("a.x") == "1"
+    assert aisafe.get("a.y") == "2"
+
+
+@pytest.mark.parametrize("mode", ["plaintext", "encrypted"])
+def test_transaction_rollback(credentials: Path, mode: str) -> None:
+    if mode == "encrypted":
+        aisafe.unlock("pw")
+    aisafe.set("a.x", "1")
+    with pytest.raises(RuntimeError):
+        with aisafe.transaction():
+            aisafe.set("a.x", "2")
+            aisafe.set("a.y", "3")
+            raise RuntimeError
+    assert aisafe.get("a.x") == "1"
+    assert aisafe.get("a.y") is None
+    restart()
+    if mode == "encrypted":
+        aisafe.unlock("pw")
+    assert aisafe.get("a.x") == "1"
+    assert aisafe.get("a.y") is None
+
+
+def test_get_sees_new_value(credentials: Path) -> None:
+    aisafe.set("a.x", "1")
+    assert aisafe.get("a.x") == "1"
+    aisafe.set("a.x", "2")
+    assert aisafe.get("a.x") == "2"
+
+
+def test_atomic_write_leaves_no_temp_files(credentials: Path) -> None:
+    aisafe.set("a.x", "1")
+    aisafe.set("a.x", "2")
+    assert [p.name for p in credentials.parent.iterdir()] == [credentials.name]